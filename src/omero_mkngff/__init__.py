@@ -19,9 +19,26 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import os
+import sqlite3
 from argparse import Namespace
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from hashlib import blake2b
+from itertools import chain
 from pathlib import Path
-from typing import Generator, Tuple
+from tempfile import NamedTemporaryFile, TemporaryFile
+from typing import (
+    IO,
+    Callable,
+    Dict,
+    FrozenSet,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
 import omero.all  # noqa
 from omero.cli import BaseControl, Parser
@@ -42,6 +59,9 @@ Examples:
     # ... while overriding the name of the directory under the ManagedRepository
     omero mkngff sql ${fileset} ${zarrdir} --zarr_name "nice.ome.zarr"
 
+    # Generate SQL for several filesets listed as "${fileset} ${zarrdir}" lines
+    omero mkngff sql-bulk filesets.txt
+
 """
 FS_SUFFIX_HELP = (
     "New Fileset.templatePrefix will be old Fileset.templatePrefix + fs_suffix. "
@@ -124,7 +144,8 @@ $BODY$
     DETAILS2="old_perms, new_event, old_group, old_owner, new_event",
 )
 
-TEMPLATE = """
+# TEMPLATE_HEAD + ",\n".join(rows) + TEMPLATE_TAIL, one row per file
+TEMPLATE_HEAD = """
 begin;
     select mkngff_fileset(
       {OLD_FILESET},
@@ -132,17 +153,92 @@ begin;
       '{REPO}',
       '{PREFIX}',
       array[
-{ROWS}
+"""
+
+TEMPLATE_TAIL = """
       ]::text[][]
     );
 commit;
 """
 
-ROW = """          ['{PATH}', '{NAME}', '{MIME}', '{CLIENTPATH}']"""
+# Maximum number of fileset IDs looked up per query, in OMERO or in the
+# lookup cache, to stay below the limits on bound parameters and on the
+# size of the reply
+QUERY_BATCH = 500
+
+# Fileset prefixes and managed repository UUIDs looked up from OMERO are kept
+# in meta.sqlite under the cache directory (see MkngffControl.get_cache_dir),
+# keyed by the UUID of the server's database, so that repeated invocations
+# do not need to query them again (see --no-cache)
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fileset(
+    db_uuid TEXT,
+    fileset_id INTEGER,
+    prefix TEXT,
+    PRIMARY KEY (db_uuid, fileset_id)
+);
+CREATE TABLE IF NOT EXISTS repository(
+    db_uuid TEXT PRIMARY KEY,
+    mrepo_uuid TEXT
+);
+"""
+
+# Seconds to wait for another process holding a lock on meta.sqlite before
+# falling back to OMERO (rather than sqlite's default of 5 seconds)
+CACHE_TIMEOUT = 0.1
+
+PREFIX_HELP = (
+    "Use this Fileset.templatePrefix instead of looking it up in OMERO, "
+    "e.g. as printed in the '-- prefix:' comment of the sql output"
+)
+
+NO_CACHE_HELP = (
+    "Do not read or update the lookup cache in ~/.cache/omero-mkngff "
+    "(or $XDG_CACHE_HOME/omero-mkngff)"
+)
+
+CACHE_SQL_HELP = (
+    "Print the SQL cached in ~/.cache/omero-mkngff/sql (or under "
+    "$XDG_CACHE_HOME) by an earlier run with the same arguments, and cache "
+    "newly generated SQL there. Only the modification time of symlink_target "
+    "itself is checked: files added or removed deeper in the NGFF data are NOT "
+    "detected."
+)
+
+# Bump whenever the generated SQL changes so older cached SQL is not reused
+SQL_CACHE_VERSION = 1
+# Least recently used SQL files are removed beyond this total size, apart
+# from the one just written
+SQL_CACHE_MAX_BYTES = 256 << 20
+
+# Whether create_symlink can work relative to a ManagedRepository fd
+DIR_FD_SUPPORTED = {os.mkdir, os.symlink} <= os.supports_dir_fd and hasattr(
+    os, "O_DIRECTORY"
+)
+REPO_FD_FLAGS = getattr(os, "O_PATH", os.O_RDONLY) | getattr(os, "O_DIRECTORY", 0)
+
+# Maximum number of entries in each list yielded by MkngffControl.walk
+WALK_BATCH = 1024
+
+# Size of the reads used to copy spooled SQL rows to the output
+CHUNK_SIZE = 1 << 20
+
+# Whether a directory is a zarr array and, if it is a group, its entries
+# (see MkngffControl.classify)
+Classified = Tuple[bool, Optional[List["os.DirEntry[str]"]]]
+# A directory entry paired with the pending classification of its contents,
+# if it is a directory (see MkngffControl.walk)
+Scanned = Tuple["os.DirEntry[str]", Optional["Future[Classified]"]]
 
 
 class MkngffControl(BaseControl):
     suffix = "_mkngff"
+    _mrepo_uuid: Optional[str] = None
+    _db_uuid: Optional[str] = None
+    _cache: Optional[sqlite3.Connection] = None
+    _cache_failed = False
+    _repo_fd: Optional[Tuple[str, Optional[int]]] = None
+    _created_dirs: FrozenSet[str] = frozenset()
 
     def _configure(self, parser: Parser) -> None:
         parser.add_login_arguments()
@@ -176,10 +272,47 @@ class MkngffControl(BaseControl):
             "--clientpath", help=("Base path to create clientpath/path/to/img.zarr/")
         )
         sql.add_argument("--fs_suffix", default="_mkngff", help=FS_SUFFIX_HELP)
+        sql.add_argument("--no-cache", action="store_true", help=NO_CACHE_HELP)
+        sql.add_argument("--cache-sql", action="store_true", help=CACHE_SQL_HELP)
+        sql.add_argument("--prefix", help=PREFIX_HELP)
         sql.add_argument("fileset_id", type=int)
         sql.add_argument("symlink_target")
         sql.set_defaults(func=self.sql)
 
+        bulk = sub.add_parser(
+            "sql-bulk", help="generate SQL statements for a list of filesets"
+        )
+        bulk.add_argument(
+            "--secret",
+            help="DB UUID for protecting SQL statements",
+            default="SECRETUUID",
+        )
+        bulk.add_argument(
+            "--symlink_repo",
+            help=(
+                "Create symlinks from each Fileset to its symlink_target using"
+                "this ManagedRepo path, e.g. /data/OMERO/ManagedRepository"
+            ),
+        )
+        bulk.add_argument(
+            "--bfoptions",
+            action="store_true",
+            help=(
+                "Create data.zarr.bfoptions files if --symlink_repo has been provided"
+            ),
+        )
+        bulk.add_argument("--fs_suffix", default="_mkngff", help=FS_SUFFIX_HELP)
+        bulk.add_argument("--no-cache", action="store_true", help=NO_CACHE_HELP)
+        bulk.add_argument("--cache-sql", action="store_true", help=CACHE_SQL_HELP)
+        bulk.add_argument(
+            "filesets",
+            help=(
+                "File with one 'fileset_id symlink_target [clientpath]' "
+                "line per fileset"
+            ),
+        )
+        bulk.set_defaults(func=self.sql_bulk)
+
         # symlink command to ONLY create symlinks
         # useful if you have previously generated
         # the corresponding sql for a Fileset
@@ -197,6 +330,8 @@ class MkngffControl(BaseControl):
             "--bfoptions", action="store_true", help="Create data.zarr.bfoptions file"
         )
         symlink.add_argument("--fs_suffix", default="_mkngff", help=FS_SUFFIX_HELP)
+        symlink.add_argument("--no-cache", action="store_true", help=NO_CACHE_HELP)
+        symlink.add_argument("--prefix", help=PREFIX_HELP)
         symlink.add_argument(
             "--clientpath",
             help=("Adds omezarr.alt_store=clientpath/path/to/img.zarr to bfoptions"),
@@ -213,6 +348,8 @@ class MkngffControl(BaseControl):
         bfoptions.add_argument("fileset_id", type=int)
         bfoptions.add_argument("symlink_target")
         bfoptions.add_argument("--fs_suffix", default="_mkngff", help=FS_SUFFIX_HELP)
+        bfoptions.add_argument("--no-cache", action="store_true", help=NO_CACHE_HELP)
+        bfoptions.add_argument("--prefix", help=PREFIX_HELP)
         bfoptions.set_defaults(func=self.bfoptions)
 
     def setup(self, args: Namespace) -> None:
@@ -221,7 +358,45 @@ class MkngffControl(BaseControl):
     def sql(self, args: Namespace) -> None:
         prefix = self.get_prefix(args)
         self.suffix = "" if args.fs_suffix == "None" else args.fs_suffix
+        self.fileset_sql(args, prefix)
 
+    def sql_bulk(self, args: Namespace) -> None:
+        self.suffix = "" if args.fs_suffix == "None" else args.fs_suffix
+        filesets = self.read_filesets(args.filesets)
+        # Look up all prefixes up front rather than one query per fileset
+        prefixes = self.get_prefixes(args, [fs[0] for fs in filesets])
+        # Check all targets before printing any SQL so that a bad list
+        # does not leave only part of its SQL on stdout
+        missing = [fs[1] for fs in filesets if not os.path.exists(fs[1])]
+        if missing:
+            self.ctx.die(401, f"Symlink targets do not exist: {', '.join(missing)}")
+        for fileset_id, symlink_target, clientpath in filesets:
+            fs_args = Namespace(**vars(args))
+            fs_args.fileset_id = fileset_id
+            fs_args.symlink_target = symlink_target
+            fs_args.clientpath = clientpath
+            self.fileset_sql(fs_args, prefixes[fileset_id])
+
+    def read_filesets(self, path: str) -> List[Tuple[int, str, Optional[str]]]:
+        filesets = []
+        seen = set()
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith("#"):
+                    continue
+                if len(fields) not in (2, 3) or not fields[0].isdigit():
+                    self.ctx.die(403, f"Invalid line in {path}: {line.rstrip()}")
+                # A second mkngff_fileset call for the same fileset would
+                # create an orphaned fileset, as no images are left to update
+                if int(fields[0]) in seen:
+                    self.ctx.die(403, f"Duplicate fileset in {path}: {line.rstrip()}")
+                seen.add(int(fields[0]))
+                clientpath = fields[2] if len(fields) == 3 else None
+                filesets.append((int(fields[0]), fields[1], clientpath))
+        return filesets
+
+    def fileset_sql(self, args: Namespace, prefix: str) -> None:
         self.ctx.err(f"Found prefix: {prefix} for fileset: {args.fileset_id}")
 
         symlink_path = Path(args.symlink_target)
@@ -240,55 +415,19 @@ class MkngffControl(BaseControl):
                 )
                 return
 
-        rows = []
-        # Need a file to set path/name on pixels table BioFormats uses for setId()
-        setid_target = None
-        for row_path, row_name, row_mime in self.walk(symlink_path):
-            row_clientpath = "unknown"
-            if args.clientpath:
-                # zarr_path is relative URL from .zarr /to/file/
-                zarr_path = str(row_path).replace(args.symlink_target, "")
-                row_clientpath = f"{args.clientpath}{zarr_path}/{row_name}"
-
-            # remove common path to shorten
-            row_path = str(row_path).replace(f"{symlink_path.parent}", "")  # type: ignore # noqa
-            if str(row_path).startswith("/"):
-                # remove "/" from start
-                row_path = str(row_path)[1:]  # type: ignore
-            row_full_path = f"{prefix}{self.suffix}/{row_path}"
-            # pick the first .zattrs file we find, then update to ome.xml if we find it
-            if (
-                setid_target is None
-                and row_name == ".zattrs"
-                or row_name == "METADATA.ome.xml"
-            ):
-                setid_target = [row_full_path, row_name]
-            rows.append(
-                ROW.format(
-                    PATH=f"{row_full_path}/",
-                    NAME=row_name,
-                    MIME=row_mime,
-                    CLIENTPATH=row_clientpath,
-                )
-            )
-
-        # Add a command to update the Pixels table with
-        # path/name using old Fileset ID *before* new Fileset is created
-        fpath = setid_target[0]  # type: ignore
-        fname = setid_target[1]  # type: ignore
-        self.ctx.out(
-            f"UPDATE pixels SET name = '{fname}', path = '{fpath}' where image in (select id from Image where fileset = {args.fileset_id});"  # noqa
-        )
-
-        self.ctx.out(
-            TEMPLATE.format(
-                OLD_FILESET=args.fileset_id,
-                PREFIX=f"{prefix}{self.suffix}/",
-                ROWS=",\n".join(rows),
-                REPO=self.get_uuid(args),
-                UUID=args.secret,
-            )
-        )
+        sql_path = self.get_sql_cache(args, prefix, symlink_path)
+        if sql_path is None:
+            self.write_sql(args, prefix, symlink_path, self.write_out)
+        elif sql_path.exists():
+            self.ctx.err(f"Using cached SQL from {sql_path}")
+            with open(sql_path, encoding="utf-8") as f:
+                self.copy_out(f, self.write_out)
+            try:
+                os.utime(sql_path)  # mark as recently used, see prune_sql_cache
+            except OSError:
+                pass
+        else:
+            self.cache_sql(args, prefix, symlink_path, sql_path)
 
         # Finally create *self.suffix/ directory containing symlink to data
         if args.symlink_repo:
@@ -298,6 +437,148 @@ class MkngffControl(BaseControl):
                     args.symlink_repo, prefix, args.symlink_target, args.clientpath
                 )
 
+    def write_sql(
+        self,
+        args: Namespace,
+        prefix: str,
+        symlink_path: Path,
+        out: Callable[[str], None],
+    ) -> None:
+        base = f"{prefix}{self.suffix}/"
+        # All paths from walk() start with the target, as normalised by Path,
+        # which is replaced by just its name under the new prefix
+        root_len = len(os.fspath(symlink_path))
+        zarr_base = f"{base}{symlink_path.name}"
+        # Rows are spooled to a temporary file rather than kept in memory:
+        # the UPDATE statement which has to be printed first depends on the
+        # whole walk, but the rows themselves can be copied out afterwards.
+        with TemporaryFile("w+", encoding="utf-8") as rows:
+            write = rows.write
+            sep = ""
+            # Need a file to set path/name on pixels table BioFormats uses for setId()
+            setid_target = None
+            for row_path, row_name, row_mime in chain.from_iterable(
+                self.walk(symlink_path)
+            ):
+                # zarr_path is relative URL from .zarr /to/file/
+                zarr_path = row_path[root_len:]
+                row_clientpath = "unknown"
+                if args.clientpath:
+                    row_clientpath = f"{args.clientpath}{zarr_path}/{row_name}"
+                row_full_path = f"{zarr_base}{zarr_path}"
+                # pick the first .zattrs file we find,
+                # then update to ome.xml if we find it
+                if row_name == "METADATA.ome.xml" or (
+                    setid_target is None and row_name == ".zattrs"
+                ):
+                    setid_target = [row_full_path, row_name]
+                write(
+                    f"{sep}          ['{row_full_path}/', '{row_name}', "
+                    f"'{row_mime}', '{row_clientpath}']"
+                )
+                sep = ",\n"
+
+            # Add a command to update the Pixels table with
+            # path/name using old Fileset ID *before* new Fileset is created
+            fpath = setid_target[0]  # type: ignore
+            fname = setid_target[1]  # type: ignore
+            out(f"-- prefix: {prefix}\n")
+            out(
+                f"UPDATE pixels SET name = '{fname}', path = '{fpath}' where image in (select id from Image where fileset = {args.fileset_id});\n"  # noqa
+            )
+
+            head = TEMPLATE_HEAD.format(
+                OLD_FILESET=args.fileset_id,
+                PREFIX=base,
+                REPO=self.get_uuid(args),
+                UUID=args.secret,
+            )
+            out(head)
+            rows.seek(0)
+            self.copy_out(rows, out)
+            out(TEMPLATE_TAIL + "\n")
+
+    def write_out(self, text: str) -> None:
+        self.ctx.out(text, newline=False)
+
+    def copy_out(self, f: IO[str], out: Callable[[str], None]) -> None:
+        for chunk in iter(partial(f.read, CHUNK_SIZE), ""):
+            out(chunk)
+
+    def get_sql_cache(
+        self, args: Namespace, prefix: str, symlink_path: Path
+    ) -> Optional[Path]:
+        if not args.cache_sql:
+            return None
+        # Everything the generated SQL depends on, apart from the files
+        # below the target, which are assumed unchanged while its mtime is
+        key = blake2b(digest_size=16)
+        for part in (
+            SQL_CACHE_VERSION,
+            self.get_db_uuid(args),
+            self.get_uuid(args),
+            args.fileset_id,
+            args.secret,
+            prefix,
+            self.suffix,
+            args.clientpath,
+            os.path.abspath(symlink_path),
+            symlink_path.stat().st_mtime_ns,
+        ):
+            key.update(f"{part}\0".encode())
+
+        try:
+            sql_dir = self.get_cache_dir() / "sql"
+            sql_dir.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            self.ctx.err(f"Not caching SQL: {e}")
+            return None
+        return sql_dir / f"{key.hexdigest()}.sql"
+
+    def cache_sql(
+        self, args: Namespace, prefix: str, symlink_path: Path, sql_path: Path
+    ) -> None:
+        # Write to a temporary file first so an interrupted run
+        # never leaves a partial SQL file in the cache
+        try:
+            tmp = NamedTemporaryFile(
+                "w", encoding="utf-8", dir=sql_path.parent, delete=False
+            )
+        except OSError as e:
+            # e.g. an existing cache directory which is not writable
+            self.ctx.err(f"Not caching SQL: {e}")
+            self.write_sql(args, prefix, symlink_path, self.write_out)
+            return
+        try:
+            with tmp:
+
+                def out(text: str) -> None:
+                    self.write_out(text)
+                    tmp.write(text)
+
+                self.write_sql(args, prefix, symlink_path, out)
+            os.replace(tmp.name, sql_path)
+        finally:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+        self.prune_sql_cache(sql_path)
+
+    def prune_sql_cache(self, sql_path: Path) -> None:
+        # sql_path has just been written and is always kept, even on its own
+        # over SQL_CACHE_MAX_BYTES, since caching it is the point of the run
+        try:
+            total = sql_path.stat().st_size
+            cached = [(p.stat(), p) for p in sql_path.parent.glob("*.sql")]
+            cached.sort(key=lambda x: x[0].st_mtime, reverse=True)
+            for st, p in cached:
+                if p == sql_path:
+                    continue
+                total += st.st_size
+                if total > SQL_CACHE_MAX_BYTES:
+                    p.unlink()
+        except OSError as e:
+            self.ctx.err(f"Failed to prune SQL cache in {sql_path.parent}: {e}")
+
     def bfoptions(self, args: Namespace) -> None:
         self.suffix = "" if args.fs_suffix == "None" else args.fs_suffix
         prefix = self.get_prefix(args)
@@ -315,40 +596,81 @@ class MkngffControl(BaseControl):
             )
 
     def get_prefix(self, args):  # type: ignore
-        conn = self.ctx.conn(args)  # noqa
-        q = conn.sf.getQueryService()
-        rv = q.findAllByQuery(
-            (
-                "select f from Fileset f join fetch f.usedFiles fe "
-                "join fetch fe.originalFile ofile where f.id = :id"
-            ),
-            ParametersI().addId(args.fileset_id),
-        )
-        if len(rv) != 1:
-            self.ctx.die(400, f"Found wrong number of filesets: {len(rv)}")
-            return
-
-        prefix = rv[0].templatePrefix.val
-
-        if prefix.endswith("/"):
-            prefix = prefix[:-1]  # Drop ending "/"
-
-        return prefix
+        if args.prefix:
+            # Same form as a looked up prefix: relative to the ManagedRepository
+            return args.prefix.strip("/")
+        return self.get_prefixes(args, [args.fileset_id])[args.fileset_id]
+
+    def get_prefixes(self, args: Namespace, fileset_ids: List[int]) -> Dict[int, str]:
+        prefixes: Dict[int, str] = {}
+        cache = self.get_cache(args)
+        if cache is not None:
+            db_uuid = self.get_db_uuid(args)
+            try:
+                for i in range(0, len(fileset_ids), QUERY_BATCH):
+                    ids = fileset_ids[i : i + QUERY_BATCH]
+                    marks = ", ".join("?" * len(ids))
+                    prefixes.update(
+                        cache.execute(
+                            "SELECT fileset_id, prefix FROM fileset "
+                            f"WHERE db_uuid = ? AND fileset_id IN ({marks})",
+                            (db_uuid, *ids),
+                        )
+                    )
+            except sqlite3.Error as e:
+                self.cache_error(e)
+
+        query_ids = [x for x in fileset_ids if x not in prefixes]
+        if query_ids:
+            conn = self.ctx.conn(args)  # noqa
+            q = conn.sf.getQueryService()
+            found: Dict[int, str] = {}
+            for i in range(0, len(query_ids), QUERY_BATCH):
+                rv = q.projection(
+                    "select f.id, f.templatePrefix from Fileset f where f.id in (:ids)",
+                    ParametersI().addIds(query_ids[i : i + QUERY_BATCH]),
+                )
+                for fileset_id, prefix in rv:
+                    prefix = prefix.val
+                    if prefix.endswith("/"):
+                        prefix = prefix[:-1]  # Drop ending "/"
+                    found[fileset_id.val] = prefix
+            prefixes.update(found)
+
+            cache = self.get_cache(args)
+            if cache is not None and found:
+                db_uuid = self.get_db_uuid(args)
+                try:
+                    with cache:
+                        cache.executemany(
+                            "INSERT OR REPLACE INTO fileset VALUES (?, ?, ?)",
+                            [(db_uuid, k, v) for k, v in found.items()],
+                        )
+                except sqlite3.Error as e:
+                    self.cache_error(e)
+
+        missing = set(fileset_ids) - set(prefixes)
+        if missing:
+            self.ctx.die(
+                400,
+                f"Found wrong number of filesets: {len(prefixes)} "
+                f"(missing: {', '.join(map(str, sorted(missing)))})",
+            )
+        return prefixes
 
     def get_symlink_dir(self, symlink_repo, prefix):  # type: ignore
-        prefix_dir = os.path.join(symlink_repo, prefix)
+        # prefix never has a leading or trailing "/" (see get_prefix)
+        prefix_dir = symlink_repo.rstrip("/") + "/" + prefix
         self.ctx.err(f"Checking for prefix_dir {prefix_dir}")
         if not os.path.exists(prefix_dir):
             self.ctx.die(402, f"Fileset dir does not exist: {prefix_dir}")
-        symlink_dir = f"{prefix_dir}{self.suffix}"
-        return symlink_dir
+        return prefix_dir + self.suffix
 
     def write_bfoptions(self, managed_repo, fsprefix, symlink_target, clientpath=None):  # type: ignore # noqa
         file_path = Path(symlink_target)
         mkngff_dir = self.get_symlink_dir(managed_repo, fsprefix)
         # os.makedirs(mkngff_dir, exist_ok=True)
-        zarr_path = os.path.join(mkngff_dir, file_path.name)
-        bfoptions_path = f"{zarr_path}.bfoptions"
+        bfoptions_path = mkngff_dir + "/" + file_path.name + ".bfoptions"
         self.ctx.err("write bfoptions to: %s" % bfoptions_path)
         lines = ["omezarr.list_pixels=false\n", "omezarr.quick_read=true\n"]
         if clientpath is not None:
@@ -359,46 +681,197 @@ class MkngffControl(BaseControl):
     def create_symlink(self, symlink_repo, prefix, symlink_target):  # type: ignore # noqa
         symlink_path = Path(symlink_target)
         symlink_dir = self.get_symlink_dir(symlink_repo, prefix)
-        self.ctx.err(f"Creating dir at {symlink_dir}")
-        os.makedirs(symlink_dir, exist_ok=True)
+        symlink_source = symlink_dir + "/" + symlink_path.name
+
+        # Resolve paths relative to an fd for symlink_repo where supported
+        repo_fd = self.get_repo_fd(symlink_repo)
+        if repo_fd is None:
+            rel_dir, rel_source = symlink_dir, symlink_source
+        else:
+            rel_dir = prefix + self.suffix
+            rel_source = rel_dir + "/" + symlink_path.name
+
+        if symlink_dir not in self._created_dirs:
+            self.ctx.err(f"Creating dir at {symlink_dir}")
+            try:
+                # The prefix dir is known to exist (see get_symlink_dir)
+                os.mkdir(rel_dir, dir_fd=repo_fd)
+            except FileExistsError:
+                pass
+            except FileNotFoundError:
+                # fs_suffix containing a "/"
+                os.makedirs(symlink_dir, exist_ok=True)
+            self._created_dirs = self._created_dirs | {symlink_dir}
 
-        symlink_source = os.path.join(symlink_dir, symlink_path.name)
         target_is_directory = os.path.isdir(symlink_target)
         self.ctx.err(f"Creating symlink {symlink_source} -> {symlink_target}")
-        # ignore if symlink exists
-        if not os.path.exists(symlink_source):
-            os.symlink(symlink_target, symlink_source, target_is_directory)
-
-    def walk(self, path: Path) -> Generator[Tuple[Path, str, str], None, None]:
-        for p in path.iterdir():
-            if not p.is_dir():
-                yield (p.parent, p.name, "application/octet-stream")
-            else:
-                is_array = (p / ".zarray").exists()
-                if is_array or (p / ".zgroup").exists():
-                    # If array, don't recursively check sub-dirs
+        try:
+            os.symlink(symlink_target, rel_source, target_is_directory, dir_fd=repo_fd)
+        except FileExistsError:
+            pass  # ignore if symlink exists
+
+    def get_repo_fd(self, symlink_repo: str) -> Optional[int]:
+        if not DIR_FD_SUPPORTED:
+            return None
+        if self._repo_fd is None or self._repo_fd[0] != symlink_repo:
+            if self._repo_fd is not None and self._repo_fd[1] is not None:
+                os.close(self._repo_fd[1])
+            fd: Optional[int]
+            try:
+                # O_PATH only needs search permission, like the path-based
+                # calls, where O_RDONLY would also need read permission
+                fd = os.open(symlink_repo, REPO_FD_FLAGS)
+            except PermissionError:
+                fd = None  # use absolute paths instead
+            self._repo_fd = (symlink_repo, fd)
+        return self._repo_fd[1]
+
+    def walk(self, path: Path) -> Generator[List[Tuple[str, str, str]], None, None]:
+        # Depth-first, in directory order, without recursion. Sub-directories
+        # are classified with stat probes, and only groups are listed, ahead
+        # of time on a thread pool (os.stat and os.scandir release the GIL)
+        # while the results are still consumed, and emitted, in order.
+        # Results are yielded in lists of up to WALK_BATCH entries.
+        root = os.fspath(path)
+        batch: List[Tuple[str, str, str]] = []
+        workers = (os.cpu_count() or 1) * 2
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+
+            def prefetch(entries: List["os.DirEntry[str]"]) -> Iterator[Scanned]:
+                return iter(
+                    [
+                        (e, pool.submit(self.classify, e.path) if e.is_dir() else None)
+                        for e in entries
+                    ]
+                )
+
+            stack = deque([(root, prefetch(self.scan(root)))])
+            while stack:
+                dirpath, entries = stack[-1]
+                for entry, scanned in entries:
+                    if len(batch) >= WALK_BATCH:
+                        yield batch
+                        batch = []
+                    if scanned is None:
+                        batch.append((dirpath, entry.name, "application/octet-stream"))
+                        continue
+                    is_array, children = scanned.result()
                     if is_array:
-                        yield (p, ".zarray", "application/octet-stream")
-                    else:
-                        yield from self.walk(p)
+                        # If array, don't recursively check sub-dirs
+                        batch.append(
+                            (entry.path, ".zarray", "application/octet-stream")
+                        )
+                    elif children is not None:
+                        stack.append((entry.path, prefetch(children)))
+                        break
+                    # else: non-zarr directory
                 else:
-                    # Non-zarr directory
-                    continue
+                    stack.pop()
+        if batch:
+            yield batch
+
+    def classify(self, path: str) -> Classified:
+        # Arrays are never listed: with a flat chunk layout they can hold
+        # a very large number of files
+        if os.path.exists(path + "/.zarray"):
+            return True, None
+        if os.path.exists(path + "/.zgroup"):
+            return False, self.scan(path)
+        return False, None
+
+    def scan(self, path: str) -> List["os.DirEntry[str]"]:
+        with os.scandir(path) as it:
+            return list(it)
 
     def get_uuid(self, args: Namespace) -> str:
+        if self._mrepo_uuid is not None:
+            return self._mrepo_uuid
+
+        cache = self.get_cache(args)
+        if cache is not None:
+            try:
+                row = cache.execute(
+                    "SELECT mrepo_uuid FROM repository WHERE db_uuid = ?",
+                    (self.get_db_uuid(args),),
+                ).fetchone()
+            except sqlite3.Error as e:
+                self.cache_error(e)
+                row = None
+            if row is not None:
+                self._mrepo_uuid = row[0]
+                return row[0]
+
         from omero.grid import ManagedRepositoryPrx as MRepo
 
         client = self.ctx.conn(args)
         shared = client.sf.sharedResources()
         repos = shared.repositories()
         repos = list(zip(repos.descriptions, repos.proxies))
+        # Each checkedCast is a remote call, so try the repository which is
+        # named like the managed repository by default before the others
+        repos.sort(key=lambda pair: pair[0].name.val != "ManagedRepository")
 
         for idx, pair in enumerate(repos):
             desc, prx = pair
             is_mrepo = MRepo.checkedCast(prx)
             if is_mrepo:
-                return desc.hash.val
+                self._mrepo_uuid = desc.hash.val
+                cache = self.get_cache(args)
+                if cache is not None:
+                    db_uuid = self.get_db_uuid(args)
+                    try:
+                        with cache:
+                            cache.execute(
+                                "INSERT OR REPLACE INTO repository VALUES (?, ?)",
+                                (db_uuid, desc.hash.val),
+                            )
+                    except sqlite3.Error as e:
+                        self.cache_error(e)
+                return self._mrepo_uuid
 
         raise self.ctx.die(
             402, f"Failed to find managed repository (count={len(repos)})"
         )
+
+    def get_db_uuid(self, args: Namespace) -> str:
+        # Unlike omero.host and omero.port, which are often the same for
+        # many development servers, the database UUID identifies where the
+        # cached prefixes and repository UUIDs came from
+        if self._db_uuid is None:
+            client = self.ctx.conn(args)
+            self._db_uuid = client.sf.getConfigService().getDatabaseUuid()
+        return self._db_uuid
+
+    def get_cache_dir(self) -> Path:
+        # Not worked out at import time: without $HOME or a passwd entry
+        # for the user there is no home directory to put the cache in
+        cache_home = os.environ.get("XDG_CACHE_HOME")
+        if not cache_home:
+            home = os.path.expanduser("~")
+            if home == "~":
+                raise OSError("Cannot determine the home directory")
+            cache_home = os.path.join(home, ".cache")
+        return Path(cache_home) / "omero-mkngff"
+
+    def get_cache(self, args: Namespace) -> Optional[sqlite3.Connection]:
+        if args.no_cache or self._cache_failed:
+            return None
+        if self._cache is None:
+            try:
+                cache_dir = self.get_cache_dir()
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                cache = sqlite3.connect(
+                    str(cache_dir / "meta.sqlite"), timeout=CACHE_TIMEOUT
+                )
+                cache.executescript(CACHE_SCHEMA)
+            except (OSError, sqlite3.Error) as e:
+                self.cache_error(e)
+                return None
+            self._cache = cache
+        return self._cache
+
+    def cache_error(self, e: Exception) -> None:
+        # e.g. "database is locked" while another process writes to it:
+        # carry on without the cache, looking everything up in OMERO
+        self.ctx.err(f"Not using the lookup cache: {e}")
+        self._cache_failed = True
@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2023 German BioImaging.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import sqlite3
+from argparse import Namespace
+from itertools import chain
+from types import SimpleNamespace
+
+import omero_mkngff
+import pytest
+from omero.rtypes import unwrap
+from omero_mkngff import MkngffControl
+
+MIME = "application/octet-stream"
+
+
+class Died(Exception):
+    pass
+
+
+class FakeQuery:
+    def __init__(self, prefixes):  # type: ignore
+        self.prefixes = prefixes
+        self.calls = []
+
+    def projection(self, query, params):  # type: ignore
+        ids = [unwrap(x) for x in unwrap(params.map["ids"])]
+        self.calls.append(ids)
+        return [
+            [SimpleNamespace(val=x), SimpleNamespace(val=self.prefixes[x])]
+            for x in ids
+            if x in self.prefixes
+        ]
+
+
+class FakeClient:
+    def __init__(self, prefixes, db_uuid="DB-UUID"):  # type: ignore
+        self.query = FakeQuery(prefixes)
+        self.repo_calls = 0
+        self.descriptions = [
+            SimpleNamespace(
+                name=SimpleNamespace(val="ManagedRepository"),
+                hash=SimpleNamespace(val="MREPO-UUID"),
+            )
+        ]
+        self.proxies = ["managed"]
+        self.sf = SimpleNamespace(
+            getQueryService=lambda: self.query,
+            getConfigService=lambda: SimpleNamespace(getDatabaseUuid=lambda: db_uuid),
+            sharedResources=lambda: SimpleNamespace(repositories=self.repositories),
+        )
+
+    def repositories(self):  # type: ignore
+        self.repo_calls += 1
+        return SimpleNamespace(descriptions=self.descriptions, proxies=self.proxies)
+
+
+class FakeContext:
+    def __init__(self, client):  # type: ignore
+        self.client = client
+        self.output = []
+        self.errors = []
+
+    def conn(self, args):  # type: ignore
+        return self.client
+
+    def out(self, text, newline=True):  # type: ignore
+        self.output.append(text + ("\n" if newline else ""))
+
+    def err(self, text, newline=True):  # type: ignore
+        self.errors.append(text)
+
+    def die(self, rc, text):  # type: ignore
+        raise Died(rc, text)
+
+
+def write(path, text="{}"):  # type: ignore
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def make_zarr(root):  # type: ignore
+    """A plate-like NGFF layout with groups, arrays and a non-zarr dir"""
+    write(root / ".zgroup")
+    write(root / ".zattrs")
+    write(root / "OME" / ".zgroup")
+    write(root / "OME" / "METADATA.ome.xml", "<OME/>")
+    for i in range(2):
+        write(root / f"{i}" / ".zgroup")
+        write(root / f"{i}" / ".zattrs")
+        for r in range(2):
+            write(root / f"{i}" / f"{r}" / ".zarray")
+            for c in range(3):
+                write(root / f"{i}" / f"{r}" / f"0.{c}", "x")
+    write(root / "notzarr" / "file")
+    return root
+
+
+def baseline_walk(path):  # type: ignore
+    """The original recursive implementation of MkngffControl.walk"""
+    for p in path.iterdir():
+        if not p.is_dir():
+            yield (str(p.parent), p.name, MIME)
+        else:
+            is_array = (p / ".zarray").exists()
+            if is_array or (p / ".zgroup").exists():
+                if is_array:
+                    yield (str(p), ".zarray", MIME)
+                else:
+                    yield from baseline_walk(p)
+
+
+class TestMkngffUnit:
+    @pytest.fixture(autouse=True)
+    def cache_dir(self, tmp_path, monkeypatch):  # type: ignore
+        monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+        monkeypatch.setattr(
+            "omero.grid.ManagedRepositoryPrx.checkedCast",
+            staticmethod(lambda prx: prx == "managed"),
+        )
+        return tmp_path / "cache" / "omero-mkngff"
+
+    def control(self, prefixes=None, db_uuid="DB-UUID"):  # type: ignore
+        client = FakeClient(prefixes or {}, db_uuid)
+        return MkngffControl(FakeContext(client)), client
+
+    def sql_args(self, target, **kwargs):  # type: ignore
+        args = dict(
+            fileset_id=1,
+            symlink_target=str(target),
+            secret="SECRET",
+            clientpath=None,
+            symlink_repo=None,
+            bfoptions=False,
+            fs_suffix="_mkngff",
+            no_cache=False,
+            cache_sql=False,
+            prefix=None,
+        )
+        args.update(kwargs)
+        return Namespace(**args)
+
+    def test_walk_matches_baseline(self, tmp_path):  # type: ignore
+        root = make_zarr(tmp_path / "img.zarr")
+        walked = list(chain.from_iterable(MkngffControl().walk(root)))
+        assert walked == list(baseline_walk(root))
+        assert (str(root / "0" / "1"), ".zarray", MIME) in walked
+        assert not [x for x in walked if "notzarr" in x[0]]
+
+    def test_walk_batches(self, tmp_path, monkeypatch):  # type: ignore
+        root = make_zarr(tmp_path / "img.zarr")
+        monkeypatch.setattr(omero_mkngff, "WALK_BATCH", 2)
+        batches = list(MkngffControl().walk(root))
+        assert all(len(batch) <= 2 for batch in batches)
+        assert list(chain.from_iterable(batches)) == list(baseline_walk(root))
+
+    def test_sql_relative_target(self, tmp_path, monkeypatch):  # type: ignore
+        make_zarr(tmp_path / ".x.zarr")
+        monkeypatch.chdir(tmp_path)
+        control, _ = self.control({1: "user_0/fs/"})
+        control.sql(self.sql_args(".x.zarr/"))
+        out = "".join(control.ctx.output)
+        assert out.startswith("-- prefix: user_0/fs\n")
+        assert "['user_0/fs_mkngff/.x.zarr/', '.zgroup'," in out
+        assert "['user_0/fs_mkngff/.x.zarr/OME/', 'METADATA.ome.xml'," in out
+
+    def test_sql_clientpath(self, tmp_path):  # type: ignore
+        root = make_zarr(tmp_path / "img.zarr")
+        control, _ = self.control({1: "user_0/fs"})
+        control.sql(self.sql_args(f"{root}/", clientpath="https://x/img.zarr"))
+        out = "".join(control.ctx.output)
+        assert "'https://x/img.zarr/.zgroup']" in out
+        assert "'https://x/img.zarr/OME/METADATA.ome.xml']" in out
+
+    def test_read_filesets(self, tmp_path):  # type: ignore
+        path = tmp_path / "filesets.txt"
+        path.write_text(
+            "# fileset target [clientpath]\n"
+            "1 /data/a.zarr\n"
+            "\n"
+            "2 /data/b.zarr https://example.org/b.zarr\n"
+        )
+        control, _ = self.control()
+        assert control.read_filesets(str(path)) == [
+            (1, "/data/a.zarr", None),
+            (2, "/data/b.zarr", "https://example.org/b.zarr"),
+        ]
+
+    @pytest.mark.parametrize(
+        "line", ["1", "a /data/a.zarr", "1 /data/a.zarr https://x extra"]
+    )
+    def test_read_filesets_invalid(self, tmp_path, line):  # type: ignore
+        path = tmp_path / "filesets.txt"
+        path.write_text(f"1 /data/ok.zarr\n{line}\n")
+        control, _ = self.control()
+        with pytest.raises(Died) as exc:
+            control.read_filesets(str(path))
+        assert exc.value.args[0] == 403
+
+    def test_read_filesets_duplicate(self, tmp_path):  # type: ignore
+        path = tmp_path / "filesets.txt"
+        path.write_text("1 /data/a.zarr\n2 /data/b.zarr\n1 /data/c.zarr\n")
+        control, _ = self.control()
+        with pytest.raises(Died) as exc:
+            control.read_filesets(str(path))
+        assert exc.value.args == (
+            403,
+            f"Duplicate fileset in {path}: 1 /data/c.zarr",
+        )
+
+    def test_sql_bulk_missing_target(self, tmp_path):  # type: ignore
+        root = make_zarr(tmp_path / "a.zarr")
+        path = tmp_path / "filesets.txt"
+        path.write_text(f"1 {root}\n2 {tmp_path}/missing.zarr\n")
+        control, _ = self.control({1: "user_0/a", 2: "user_0/b"})
+        args = self.sql_args(root, filesets=str(path), no_cache=True)
+        with pytest.raises(Died) as exc:
+            control.sql_bulk(args)
+        assert exc.value.args == (
+            401,
+            f"Symlink targets do not exist: {tmp_path}/missing.zarr",
+        )
+        assert control.ctx.output == []
+
+    def test_get_prefixes_single_query(self):  # type: ignore
+        control, client = self.control({1: "user_0/a/", 2: "user_0/b"})
+        args = Namespace(no_cache=True)
+        assert control.get_prefixes(args, [1, 2]) == {1: "user_0/a", 2: "user_0/b"}
+        assert client.query.calls == [[1, 2]]
+
+    def test_get_prefixes_batched(self, monkeypatch):  # type: ignore
+        monkeypatch.setattr(omero_mkngff, "QUERY_BATCH", 2)
+        control, client = self.control({1: "a", 2: "b", 3: "c"})
+        args = Namespace(no_cache=True)
+        assert control.get_prefixes(args, [1, 2, 3]) == {1: "a", 2: "b", 3: "c"}
+        assert client.query.calls == [[1, 2], [3]]
+
+    def test_get_prefixes_missing(self):  # type: ignore
+        control, _ = self.control({1: "user_0/a"})
+        with pytest.raises(Died) as exc:
+            control.get_prefixes(Namespace(no_cache=True), [1, 2, 3])
+        assert exc.value.args == (
+            400,
+            "Found wrong number of filesets: 1 (missing: 2, 3)",
+        )
+
+    def test_get_prefix_override(self):  # type: ignore
+        control, client = self.control()
+        args = Namespace(prefix="/user_0/a/", fileset_id=1, no_cache=False)
+        assert control.get_prefix(args) == "user_0/a"
+        assert client.query.calls == []
+
+    def test_get_uuid_managed_first(self, monkeypatch):  # type: ignore
+        control, client = self.control()
+        client.descriptions = [
+            SimpleNamespace(
+                name=SimpleNamespace(val="ScriptRepository"),
+                hash=SimpleNamespace(val="SCRIPTS-UUID"),
+            ),
+            *client.descriptions,
+        ]
+        client.proxies = ["scripts", *client.proxies]
+        casts = []
+        monkeypatch.setattr(
+            "omero.grid.ManagedRepositoryPrx.checkedCast",
+            staticmethod(lambda prx: casts.append(prx) or prx == "managed"),
+        )
+        assert control.get_uuid(Namespace(no_cache=True)) == "MREPO-UUID"
+        assert casts == ["managed"]
+
+    def test_lookup_cache(self, cache_dir):  # type: ignore
+        args = Namespace(no_cache=False)
+        control, client = self.control({1: "user_0/a", 2: "user_0/b"})
+        assert control.get_prefixes(args, [1]) == {1: "user_0/a"}
+        assert control.get_uuid(args) == "MREPO-UUID"
+        assert (cache_dir / "meta.sqlite").exists()
+
+        # A new process only queries what is not cached yet
+        control, client = self.control({1: "user_0/a", 2: "user_0/b"})
+        assert control.get_prefixes(args, [1, 2]) == {1: "user_0/a", 2: "user_0/b"}
+        assert control.get_uuid(args) == "MREPO-UUID"
+        assert client.query.calls == [[2]]
+        assert client.repo_calls == 0
+
+    def test_lookup_cache_per_database(self):  # type: ignore
+        args = Namespace(no_cache=False)
+        control, _ = self.control({1: "user_0/a"})
+        control.get_prefixes(args, [1])
+        control.get_uuid(args)
+
+        # Same host and port, but e.g. a reinstalled server
+        control, client = self.control({1: "user_1/b"}, db_uuid="OTHER-DB")
+        assert control.get_prefixes(args, [1]) == {1: "user_1/b"}
+        assert control.get_uuid(args) == "MREPO-UUID"
+        assert client.query.calls == [[1]]
+        assert client.repo_calls == 1
+
+    def test_no_cache(self, cache_dir):  # type: ignore
+        control, _ = self.control({1: "user_0/a"})
+        control.get_prefixes(Namespace(no_cache=False), [1])
+
+        control, client = self.control({1: "user_0/a"})
+        args = Namespace(no_cache=True)
+        assert control.get_prefixes(args, [1]) == {1: "user_0/a"}
+        assert control.get_uuid(args) == "MREPO-UUID"
+        assert client.query.calls == [[1]]
+        assert client.repo_calls == 1
+
+    def test_no_home(self, monkeypatch):  # type: ignore
+        monkeypatch.delenv("XDG_CACHE_HOME")
+        monkeypatch.setattr("os.path.expanduser", lambda path: path)
+        control, client = self.control({1: "user_0/a"})
+        args = Namespace(no_cache=False)
+        assert control.get_prefixes(args, [1]) == {1: "user_0/a"}
+        assert client.query.calls == [[1]]
+        assert len(control.ctx.errors) == 1
+
+    def test_locked_cache(self, cache_dir):  # type: ignore
+        control, _ = self.control({1: "user_0/a"})
+        control.get_prefixes(Namespace(no_cache=False), [1])
+
+        lock = sqlite3.connect(str(cache_dir / "meta.sqlite"), isolation_level=None)
+        lock.execute("BEGIN EXCLUSIVE")
+        try:
+            control, client = self.control({1: "user_0/a"})
+            args = Namespace(no_cache=False)
+            assert control.get_prefixes(args, [1]) == {1: "user_0/a"}
+            assert control.get_uuid(args) == "MREPO-UUID"
+            assert client.query.calls == [[1]]
+            assert len(control.ctx.errors) == 1
+        finally:
+            lock.close()
+
+    def generate(self, target, **kwargs):  # type: ignore
+        control, _ = self.control({1: "user_0/a"})
+        walks = []
+        walk = control.walk
+        control.walk = lambda path: walks.append(path) or walk(path)
+        control.sql(self.sql_args(target, **kwargs))
+        return "".join(control.ctx.output), len(walks)
+
+    def test_sql_cache_opt_in(self, tmp_path, cache_dir):  # type: ignore
+        root = make_zarr(tmp_path / "img.zarr")
+        out, walks = self.generate(root)
+        assert walks == 1
+        assert self.generate(root) == (out, 1)
+        assert not (cache_dir / "sql").exists()
+
+    def test_sql_cache(self, tmp_path, cache_dir):  # type: ignore
+        root = make_zarr(tmp_path / "img.zarr")
+        out, walks = self.generate(root, cache_sql=True)
+        assert walks == 1
+        assert len(list((cache_dir / "sql").glob("*.sql"))) == 1
+
+        # Same inputs: replayed without walking
+        assert self.generate(root, cache_sql=True) == (out, 0)
+
+        # Different arguments or a touched target are regenerated
+        assert self.generate(root, cache_sql=True, secret="OTHER")[1] == 1
+        st = root.stat()
+        os.utime(root, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        assert self.generate(root, cache_sql=True) == (out, 1)
+        assert len(list((cache_dir / "sql").glob("*.sql"))) == 3
+
+    def test_sql_cache_pruned(self, tmp_path, cache_dir, monkeypatch):  # type: ignore
+        root = make_zarr(tmp_path / "img.zarr")
+        self.generate(root, cache_sql=True)
+        size = next((cache_dir / "sql").glob("*.sql")).stat().st_size
+        monkeypatch.setattr(omero_mkngff, "SQL_CACHE_MAX_BYTES", size * 2)
+        for secret in ("A", "B", "C"):
+            self.generate(root, cache_sql=True, secret=secret)
+        assert len(list((cache_dir / "sql").glob("*.sql"))) == 2
+
+    def test_sql_cache_large(self, tmp_path, cache_dir, monkeypatch):  # type: ignore
+        root = make_zarr(tmp_path / "img.zarr")
+        monkeypatch.setattr(omero_mkngff, "SQL_CACHE_MAX_BYTES", 1)
+        self.generate(root, cache_sql=True, secret="A")
+        out, walks = self.generate(root, cache_sql=True)
+        assert walks == 1
+        # Only the newest file is kept, and replayed
+        assert len(list((cache_dir / "sql").glob("*.sql"))) == 1
+        assert self.generate(root, cache_sql=True) == (out, 0)
+
+    def test_sql_cache_not_writable(self, tmp_path, monkeypatch):  # type: ignore
+        root = make_zarr(tmp_path / "img.zarr")
+        out, _ = self.generate(root)
+
+        def denied(*args, **kwargs):  # type: ignore
+            raise PermissionError("denied")
+
+        monkeypatch.setattr(omero_mkngff, "NamedTemporaryFile", denied)
+        assert self.generate(root, cache_sql=True) == (out, 1)
+
+    def test_create_symlink(self, tmp_path):  # type: ignore
+        root = make_zarr(tmp_path / "img.zarr")
+        repo = tmp_path / "ManagedRepository"
+        (repo / "user_0" / "a").mkdir(parents=True)
+        control, _ = self.control()
+        for _ in range(2):  # an existing link is ignored
+            control.create_symlink(str(repo) + "/", "user_0/a", str(root))
+        link = repo / "user_0" / "a_mkngff" / "img.zarr"
+        assert os.readlink(link) == str(root)